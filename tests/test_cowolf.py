@@ -1,11 +1,14 @@
 #!/usr/bin/python
 
+import io
 import os
+import shutil
 import signal
 import hashlib
 import subprocess
-import inspect
-import multiprocessing
+import sys
+import time
+import traceback
 
 # global stuffs
 TestDir = "testdir"
@@ -18,66 +21,164 @@ MntFile = MntDir + "/file1"
 OrigSize = 4096
 DbgFile = TestDir + "/log"
 
+# compare the whole file after every write instead of only the written data
+VerifyEach = os.environ.get("COWOLF_VERIFY_EACH", "0") == "1"
+
 # path to unionfs executable
 UfsBin = "../src/unionfs"
 
+# seconds to wait for unionfs to mount MntDir
+MountTimeout = 10
+
 # original data at the lower branch
-OrigData = bytearray(['o']*OrigSize)
+OrigData = bytearray(b'o' * OrigSize)
+OrigMd5 = hashlib.md5(OrigData).hexdigest()
 
 FailCnt = 0
 
+# buffer reused by read_fh()
+_read_buf = bytearray(64*1024)
+
+# shared file object of the mounted file, see open_mnt()
+_mnt_fh = None
+
+# the running unionfs process, see do_setup()
+_ufs_proc = None
+
 # various utility functions
 
-def do_check(cond, lineno):
+# depth: number of frames between do_check() and the checking test code
+def do_check(cond, depth = 1):
 	global FailCnt
 	if cond == False:
+		# the caller's line number is only needed to report a failure
+		lineno = sys._getframe(depth).f_lineno
 		print "FAILURE: line " + str(lineno)
 		FailCnt += 1
 
+# failure count reported back by test_func()
+class FailCount(object):
+	value = 0
+
 def create_file(fname, data):
-	fh = open(fname, 'w+')
+	fh = open(fname, 'wb+')
 	fh.write(data)
 	fh.close()
 
-def write_file(fname, data, offset = 0):
-	fh = open(fname, 'r+')
+# read up to length bytes (default: up to EOF) at offset
+# NOTE: the returned memoryview is only valid until the next read
+def read_fh(fh, offset = 0, length = None):
+	global _read_buf
+	size = os.fstat(fh.fileno()).st_size - offset
+	if length is not None:
+		size = min(size, length)
+	if size > len(_read_buf):
+		# views handed out earlier keep the old buffer alive
+		_read_buf = bytearray(size)
 	fh.seek(offset)
-	fh.write(data)
-	fh.close()
+	view = memoryview(_read_buf)
+	nread = 0
+	# a single read may return less than asked for, read until EOF
+	while nread < size:
+		n = fh.readinto(view[nread:size])
+		if not n:
+			break
+		nread += n
+	return view[:nread]
 
 def read_file(fname, offset = 0):
-	fh = open(fname, 'r')
-	fh.seek(offset)
-	data = fh.read()
+	fh = io.FileIO(fname, 'r')
+	data = read_fh(fh, offset)
 	fh.close()
 	return data
 
-def trunc_file(fname, size):
-	fh = open(fname, 'r+')
-	fh.truncate(size)
+# the mounted file is opened once and shared by all writes and truncates.
+# Reads always open it again: unionfs sets neither keep_cache nor direct_io,
+# so every open drops the page cache and the data has to come from unionfs
+# (and its cowolf read path) instead of the kernel.
+def open_mnt():
+	global _mnt_fh
+	if _mnt_fh is None:
+		_mnt_fh = io.FileIO(MntFile, 'r+')
+	return _mnt_fh
+
+def close_mnt():
+	global _mnt_fh
+	if _mnt_fh is not None:
+		_mnt_fh.close()
+		_mnt_fh = None
+
+def write_mnt(data, offset = 0):
+	fh = open_mnt()
+	fh.seek(offset)
+	fh.write(data)
+
+def trunc_mnt(size):
+	os.ftruncate(open_mnt().fileno(), size)
+
+# compare size and md5 hexdigest of the mounted file
+def check_digest(size, digest, depth = 1):
+	fdata = read_file(MntFile)
+	do_check(len(fdata) == size, depth + 1)
+	m1 = hashlib.md5(fdata).hexdigest()
+	do_check(m1 == digest, depth + 1)
+
+# compare only the size of the mounted file and the data written last,
+# the full comparison is done once at the end of a group of tests
+def quick_check(offset, data, size, depth = 1):
+	fh = io.FileIO(MntFile, 'r')
+	do_check(os.fstat(fh.fileno()).st_size == size, depth + 1)
+	do_check(read_fh(fh, offset, len(data)) == data, depth + 1)
 	fh.close()
 
+# compare the content of the mounted file with the in-memory mirror
+def check_mirror(expected, depth = 1):
+	m2 = hashlib.md5(memoryview(expected)).hexdigest()
+	check_digest(len(expected), m2, depth + 1)
+
+# check a single write of data at offset, expected mirrors the whole file
+def check_write(offset, data, expected, depth = 1):
+	if VerifyEach:
+		check_mirror(expected, depth + 1)
+	else:
+		quick_check(offset, data, len(expected), depth + 1)
+
+# start from empty branch and mount directories
+def reset_testbed():
+	shutil.rmtree(TestDir, ignore_errors = True)
+	# TestDir is gone, so makedirs() creates it along with the first one
+	for d in (LoDir, UpDir, MntDir):
+		os.makedirs(d)
+
 def create_testbed():
-	os.system("rm -rf " + TestDir)
-	os.mkdir(TestDir)
-	os.mkdir(LoDir)
-	os.mkdir(UpDir)
-	os.mkdir(MntDir)
+	reset_testbed()
 	create_file(LoFile, OrigData)
 
 def do_setup():
+	global _ufs_proc
 	print "Creating test setup..."
 	create_testbed()
-	os.system(UfsBin
-		+ " -o cow,cowolf,cowolf_file_size=10 -o auto_unmount,debug_file=" + DbgFile
-		+ " "
-		+ UpDir + "=RW:" + LoDir + "=RO "
-		+ MntDir)
+	# keep unionfs in the foreground so that we know its pid
+	_ufs_proc = subprocess.Popen([UfsBin, "-f",
+		"-o", "cow,cowolf,cowolf_file_size=10",
+		"-o", "auto_unmount,debug_file=" + DbgFile,
+		UpDir + "=RW:" + LoDir + "=RO",
+		MntDir])
+	deadline = time.time() + MountTimeout
+	while not os.path.ismount(MntDir):
+		if _ufs_proc.poll() is not None:
+			raise subprocess.CalledProcessError(_ufs_proc.returncode, UfsBin)
+		if time.time() > deadline:
+			_ufs_proc.kill()
+			_ufs_proc.wait()
+			raise RuntimeError("unionfs did not mount " + MntDir
+				+ " within " + str(MountTimeout) + " seconds")
+		time.sleep(0.01)
 
 def undo_setup():
 	print "Destroying test setup..."
-	res = subprocess.check_output(["pgrep", "-f", UfsBin, "-u",  str(os.getuid())])
-	os.kill(int(res), signal.SIGTERM)
+	_ufs_proc.send_signal(signal.SIGTERM)
+	_ufs_proc.wait()
 
 # test code
 def test_func(fc):
@@ -85,215 +186,160 @@ def test_func(fc):
 	# set it to negative value to indicate abort
 	fc.value = -1
 
-	# initial check
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(OrigData).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	# initial check, read-only before the file is copied up
+	check_digest(OrigSize, OrigMd5)
+
+	# in-memory mirror of the mounted file
+	refdata = bytearray(OrigData)
 
 	# write 10 bytes and check
 	offset = 100
 	size = 10
-	w1 = bytearray(['A']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'A' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 
 	# check upper level sparse data
-	sparsedata = bytearray([0]*OrigSize)
+	sparsedata = bytearray(OrigSize)
 	sparsedata[offset:offset+len(w1)] = w1
 	fdata = read_file(UpFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
+	do_check(len(fdata) == OrigSize)
 	m1 = hashlib.md5(fdata).hexdigest()
 	m2 = hashlib.md5(sparsedata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	do_check(m1 == m2)
 
 	# write 10 bytes and check
 	offset = 1000
 	size = 1000
-	w1 = bytearray(['B']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'B' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 
 	# overlapping write with earlier write
 	offset = 1800
 	size = 500
-	w1 = bytearray(['C']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'C' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 
 	# insert a write at the middle
 	offset = 200
 	size = 100
-	w1 = bytearray(['D']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'D' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 
 	# a write encompassing earlier writes
 	offset = 100 
 	size = 400
-	w1 = bytearray(['E']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'E' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 
 	# insert a write and merge two writes at the left and right
 	offset = 500 
 	size = 500
-	w1 = bytearray(['F']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'F' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 
 	# write at the beginning of file
 	offset = 0
 	size = 50
-	w1 = bytearray(['G']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'G' * size)
+	write_mnt(w1, offset)
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == OrigSize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	# full comparison at the end of the in-file writes
+	check_mirror(refdata)
 
 	# append
 	size = 200
 	offset = OrigSize
-	w1 = bytearray(['H']*size)
-	refdata = OrigData
-	write_file(MntFile, w1, offset)
+	w1 = bytearray(b'H' * size)
+	write_mnt(w1, offset)
 	refdata += w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == (OrigSize + size), inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_write(offset, w1, refdata)
 	new_fsize = OrigSize + size
 
 	# append overlapping existing data
 	appsz = 100
 	size = 500
 	offset = new_fsize + appsz - size
-	w1 = bytearray(['I']*size)
-	write_file(MntFile, w1, offset)
-	refdata = refdata[:offset]
-	refdata += w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == (new_fsize + appsz), inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	w1 = bytearray(b'I' * size)
+	write_mnt(w1, offset)
+	refdata[offset:] = w1
+	check_write(offset, w1, refdata)
 	new_fsize += appsz
 
 	# sparse write (making a hole)
 	holesz = 1000
 	size = 500
 	offset = new_fsize + holesz
-	holedata = bytearray([0]*holesz)
-	w1 = bytearray(['J']*size)
-	write_file(MntFile, w1, offset)
+	holedata = bytearray(holesz)
+	w1 = bytearray(b'J' * size)
+	write_mnt(w1, offset)
 	refdata[new_fsize:new_fsize+len(holedata)] = holedata
 	refdata[offset:offset+len(w1)] = w1
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == (new_fsize + holesz + size), inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	# full comparison at the end of the writes beyond EOF
+	check_mirror(refdata)
 	new_fsize += (holesz + size)
 
 	# truncate to size bigger than lower branch
 	new_fsize = OrigSize + 311
-	fdata = read_file(MntFile)
-	do_check(len(fdata) > new_fsize, inspect.currentframe().f_lineno)
-	refdata = fdata[:new_fsize]
-	trunc_file(MntFile, new_fsize)
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == new_fsize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	do_check(os.stat(MntFile).st_size > new_fsize)
+	trunc_mnt(new_fsize)
+	del refdata[new_fsize:]
+	check_mirror(refdata)
 
 	# truncate to size smaller than lower branch
 	new_fsize = (OrigSize/2) + 17
-	fdata = read_file(MntFile)
-	do_check(len(fdata) > new_fsize, inspect.currentframe().f_lineno)
-	refdata = fdata[:new_fsize]
-	trunc_file(MntFile, new_fsize)
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == new_fsize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	do_check(os.stat(MntFile).st_size > new_fsize)
+	trunc_mnt(new_fsize)
+	del refdata[new_fsize:]
+	check_mirror(refdata)
 
 	# truncate to bigger size (creating sparse area)
 	old_size = new_fsize
 	new_fsize = (6*OrigSize) + 29
-	refdata = read_file(MntFile)
-	do_check(len(fdata) < new_fsize, inspect.currentframe().f_lineno)
+	do_check(os.stat(MntFile).st_size < new_fsize)
 	sparse_size = new_fsize - old_size
-	sparse_data = bytearray([0]*sparse_size)
+	sparse_data = bytearray(sparse_size)
+	trunc_mnt(new_fsize)
 	refdata += sparse_data
-	trunc_file(MntFile, new_fsize)
-	fdata = read_file(MntFile)
-	do_check(len(fdata) == new_fsize, inspect.currentframe().f_lineno)
-	m1 = hashlib.md5(fdata).hexdigest()
-	m2 = hashlib.md5(refdata).hexdigest()
-	do_check(m1 == m2, inspect.currentframe().f_lineno)
+	check_mirror(refdata)
 
 	# truncate to zero size
-	trunc_file(MntFile, 0)
+	trunc_mnt(0)
 	fdata = read_file(MntFile)
-	do_check(len(fdata) == 0, inspect.currentframe().f_lineno)
+	do_check(len(fdata) == 0)
 
 	# append data in for-loop
 	cur_size = 0
-	refdata = bytearray()
+	md5_ref = hashlib.md5()
+	# data appended since the last quick check
+	appended = bytearray()
 	for index in range(100):
-		w1 = bytearray([index+1]*(index+1))
-		write_file(MntFile, w1, cur_size)
+		w1 = bytearray([index+1]) * (index+1)
+		write_mnt(w1, cur_size)
 		cur_size += len(w1)
-		refdata += w1
-		fdata = read_file(MntFile)
-		do_check(len(fdata) == cur_size, inspect.currentframe().f_lineno)
-		m1 = hashlib.md5(fdata).hexdigest()
-		m2 = hashlib.md5(refdata).hexdigest()
-		do_check(m1 == m2, inspect.currentframe().f_lineno)
+		# appends only extend the reference, so hash them incrementally
+		md5_ref.update(w1)
+		appended += w1
+		if VerifyEach:
+			check_digest(cur_size, md5_ref.hexdigest())
+		# otherwise check the appended data in batches of 10 writes
+		elif (index + 1) % 10 == 0:
+			quick_check(cur_size - len(appended), appended, cur_size)
+			del appended[:]
+	check_digest(cur_size, md5_ref.hexdigest())
+
+	close_mnt()
 
 	# very last statement of test func
 	fc.value = FailCnt
@@ -301,18 +347,33 @@ def test_func(fc):
 
 # set up function: do setup and fork a process to execute the tests
 def main():
-	fail_count = multiprocessing.Value('i', 0)
 	do_setup()
-	p = multiprocessing.Process(target=test_func, args=(fail_count,))
-	p.start()
-	p.join()
+	# don't let the child inherit (and print again) buffered output
+	sys.stdout.flush()
+	sys.stderr.flush()
+	pid = os.fork()
+	if pid == 0:
+		fc = FailCount()
+		try:
+			test_func(fc)
+		except:
+			traceback.print_exc()
+		sys.stdout.flush()
+		# the exit status is a byte: 255 means aborted, counts are capped
+		if fc.value < 0:
+			os._exit(255)
+		os._exit(min(fc.value, 254))
+	status = os.waitpid(pid, 0)[1]
 	undo_setup()
-	if fail_count.value == 0:
+	fail_count = -1
+	if os.WIFEXITED(status) and os.WEXITSTATUS(status) != 255:
+		fail_count = os.WEXITSTATUS(status)
+	if fail_count == 0:
 		print "***** All tests passed. *****"
-	elif fail_count.value < 0:
+	elif fail_count < 0:
 		print "****** Test Aborted. *******"
 	else:
-		print "***** Test failed in " + str(fail_count.value) + " occasions. *******"
+		print "***** Test failed in " + str(fail_count) + " occasions. *******"
 
 if __name__ == "__main__":
 	main()